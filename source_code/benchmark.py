@@ -0,0 +1,434 @@
+# Throughput and latency benchmarks for the request routing pipeline
+# Run from the directory containing main.py:
+#   python benchmark.py --requests 20000 --users 1000 --premium-ratio 0.2 --mix music=4,fitness=3,study=2,general=1
+#   python benchmark.py --save baseline.json          (record a baseline)
+#   python benchmark.py --compare baseline.json       (compare against it, exit code 1 on regressions)
+#   python benchmark.py --repeats 9 --warmup 2        (more rounds per scenario for a steadier median)
+#   python benchmark.py --startup                     (also time import, construction and first requests)
+#   python benchmark.py --snapshot-users 1000000      (also time state snapshots and restores)
+
+import argparse
+import gc
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from main import AssistantManager, CommandParser, CommandType, GreetingStore, Request, syntheticRequests
+
+
+class BenchmarkConfig:
+    # Shape of the synthetic traffic: how many requests, users, the share of premium users,
+    # the weight of each command type and how many extra study topics and songs the catalogs hold
+    def __init__(self, requests=20000, users=1000, premium_ratio=0.2, mix=None, catalog_size=0, seed=0):
+        if not isinstance(requests, int) or requests <= 0:
+            raise ValueError("requests must be a positive integer")
+        if not isinstance(users, int) or users <= 0:
+            raise ValueError("users must be a positive integer")
+        if not 0.0 <= premium_ratio <= 1.0:
+            raise ValueError("premium_ratio must be between 0.0 and 1.0")
+        if not isinstance(catalog_size, int) or catalog_size < 0:
+            raise ValueError("catalog_size must be a non negative integer")
+
+        self.requests = requests
+        self.users = users
+        self.premium_ratio = premium_ratio
+        self.mix = mix if mix else {command_type: 1 for command_type in CommandType}
+        self.catalog_size = catalog_size
+        self.seed = seed
+
+    def catalogTopics(self):
+        return [f"course {index}" for index in range(self.catalog_size)]
+
+    def toDict(self):
+        return {
+            "requests": self.requests,
+            "users": self.users,
+            "premium_ratio": self.premium_ratio,
+            "mix": {command_type.value: weight for command_type, weight in self.mix.items()},
+            "catalog_size": self.catalog_size,
+            "seed": self.seed
+        }
+
+
+def parse_mix(text):
+    # "music=4,fitness=3" -> {CommandType.MUSIC: 4.0, CommandType.FITNESS: 3.0}
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        try:
+            mix[CommandType[name.strip().upper()]] = float(weight)
+        except (KeyError, ValueError):
+            raise argparse.ArgumentTypeError(f"Invalid mix entry '{part}', expected e.g. music=4")
+    return mix
+
+
+def build_manager(config):
+    # AssistantManager whose knowledge base and music catalog also hold catalog_size synthetic entries
+    manager = AssistantManager()
+    study = manager.assistants[CommandType.STUDY]
+    for topic in config.catalogTopics():
+        study.addTopic(topic, f"{topic.title()} covers one part of the course catalog.")
+    if config.catalog_size:
+        moods = ["happy", "sad", "energetic", "relaxing", "romantic"]
+        genres = ["rock", "pop", "jazz", "classical"]
+        manager.assistants[CommandType.MUSIC].addSongs(
+            (f"Track {index} - Artist {index % 997}", moods[index % len(moods)], genres[index % len(genres)], (index * 7919) % 1000)
+            for index in range(config.catalog_size))
+    return manager
+
+
+def generate_traffic(config):
+    topics = config.catalogTopics() or None
+    return syntheticRequests(config.requests, config.users, config.seed, config.mix, config.premium_ratio, topics)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure(operation, items):
+    # Call operation once per item and return (total seconds, sorted per call latencies in ns)
+    # The garbage collector is paused like timeit does, so a collection left over from the setup
+    # doesn't land in one round and not another
+    latencies = []
+    record = latencies.append
+    clock = time.perf_counter_ns
+    gc.collect()
+    gc.disable()
+    try:
+        start = clock()
+        for item in items:
+            before = clock()
+            operation(item)
+            record(clock() - before)
+        total = (clock() - start) / 1e9
+    finally:
+        gc.enable()
+    latencies.sort()
+    return total, latencies
+
+
+def peak_memory(operation, items):
+    # Peak traced memory in KiB while running operation over items, measured in a separate pass
+    # because tracemalloc slows everything down
+    tracemalloc.start()
+    try:
+        for item in items:
+            operation(item)
+        return tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+
+
+def scenarios(config, traffic):
+    # (name, setup) pairs. setup returns (operation, items, operations per item) on fresh state,
+    # so every timed round and the memory pass start from the same place
+    texts = [text for _, text in traffic]
+
+    def parse_command():
+        return CommandParser().parseCommand, texts, 1
+
+    def extract_preferences():
+        return CommandParser().extractPreferences, texts, 1
+
+    def parse_batch(chunk_size=1000):
+        chunks = [texts[start:start + chunk_size] for start in range(0, len(texts), chunk_size)]
+        return CommandParser().parseBatch, chunks, chunk_size
+
+    def route_request():
+        manager = build_manager(config)
+        parser = manager.parser
+        def operation(item):
+            user, text = item
+            parsed = parser.parse(text)
+            manager.routeRequest(user, Request(text, parsed.command_type, parsed=parsed))
+        return operation, traffic, 1
+
+    def route_batch(chunk_size=1000):
+        manager = build_manager(config)
+        chunks = [traffic[start:start + chunk_size] for start in range(0, len(traffic), chunk_size)]
+        return manager.routeBatch, chunks, chunk_size
+
+    def handle_request(command_type):
+        def setup():
+            manager = build_manager(config)
+            assistant = manager.assistants[command_type]
+            items = []
+            for user, text in traffic:
+                parsed = manager.parser.parse(text)
+                if parsed.command_type == command_type:
+                    items.append((user, Request(text, command_type, parsed=parsed)))
+            def operation(item):
+                assistant.handleRequest(*item)
+            return operation, items, 1
+        return setup
+
+    named = [
+        ("parseCommand", parse_command),
+        ("extractPreferences", extract_preferences),
+        ("parseBatch (1000 per call)", parse_batch),
+        ("routeRequest (end to end)", route_request),
+        ("routeBatch (end to end, 1000 per call)", route_batch)
+    ]
+    for command_type in CommandType:
+        named.append((f"handleRequest {command_type.value}", handle_request(command_type)))
+    return named
+
+
+def run(config, measure_memory=True, repeats=5, warmup=1, round_seconds=0.2):
+    # Every scenario runs warmup untimed rounds and then repeats timed ones, and reports the median
+    # of every figure over its timed rounds. A round passes over the traffic on fresh state, again
+    # until it has taken round_seconds, so quick scenarios aren't timed over a few milliseconds.
+    # Each round times every scenario before the next round starts, so a slow spell on the machine
+    # costs every scenario one round rather than all of one scenario's. Scenarios that take a chunk
+    # per call report the p50 and p99 of whole calls ("latency_per": "call"), since the chunk's
+    # requests aren't timed one by one
+    if not isinstance(repeats, int) or repeats <= 0:
+        raise ValueError("repeats must be a positive integer")
+    if not isinstance(warmup, int) or warmup < 0:
+        raise ValueError("warmup must be a non negative integer")
+    traffic = generate_traffic(config)
+    named = scenarios(config, traffic)
+    rounds = {name: [] for name, _ in named}  # name -> [(operations, seconds, p50 us, p99 us)]
+    shapes = {}  # name -> (operations per pass, operations per item)
+    for round_number in range(warmup + repeats):
+        for name, setup in named:
+            count = total = 0
+            latencies = []
+            while total < round_seconds:
+                operation, items, per_item = setup()
+                if not items:
+                    break
+                seconds, pass_latencies = measure(operation, items)
+                shapes[name] = (sum(len(item) for item in items) if per_item > 1 else len(items), per_item)
+                count += shapes[name][0]
+                total += seconds
+                latencies.extend(pass_latencies)
+            if count and round_number >= warmup:
+                latencies.sort()
+                rounds[name].append((count, total, percentile(latencies, 0.50) / 1000, percentile(latencies, 0.99) / 1000))
+    
+    results = {}
+    for name, setup in named:
+        if not rounds[name]:
+            continue
+        throughputs = [count / total if total else 0.0 for count, total, _, _ in rounds[name]]
+        result = {
+            "operations": shapes[name][0],
+            "repeats": len(throughputs),
+            "ops_per_sec": statistics.median(throughputs),
+            "ops_per_sec_rounds": throughputs,
+            "p50_us": statistics.median(p50 for _, _, p50, _ in rounds[name]),
+            "p99_us": statistics.median(p99 for _, _, _, p99 in rounds[name]),
+            "latency_per": "call" if shapes[name][1] > 1 else "operation"
+        }
+        if measure_memory:
+            operation, items, _ = setup()
+            result["peak_kib"] = peak_memory(operation, items)
+        results[name] = result
+    return results
+
+
+STARTUP_SCRIPT = """
+import json, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+manager = main.AssistantManager()
+built = time.perf_counter()
+user = main.UserProfile("bench", 30, {}, False)
+first = {}
+for command_type, text in [(main.CommandType.MUSIC, "play happy music"), (main.CommandType.FITNESS, "cardio workout"),
+                           (main.CommandType.STUDY, "explain oop"), (main.CommandType.GENERAL, "hello")]:
+    before = time.perf_counter()
+    manager.routeRequest(user, main.Request(text, command_type))
+    first[command_type.value] = (time.perf_counter() - before) * 1000
+print(json.dumps({"import_ms": (imported - start) * 1000, "manager_ms": (built - imported) * 1000, "first_request_ms": first}))
+"""
+
+
+def measure_startup(runs=5):
+    # Import time, AssistantManager construction and the first request of each type (which builds
+    # that assistant), each measured in a fresh interpreter. Returns the median of each value
+    directory = os.path.dirname(os.path.abspath(__file__))
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], cwd=directory, capture_output=True,
+                                text=True, check=True).stdout
+        samples.append(json.loads(output))
+    middle = runs // 2
+    result = {
+        "import_ms": sorted(sample["import_ms"] for sample in samples)[middle],
+        "manager_ms": sorted(sample["manager_ms"] for sample in samples)[middle]
+    }
+    result["first_request_ms"] = {name: sorted(sample["first_request_ms"][name] for sample in samples)[middle]
+                                  for name in samples[0]["first_request_ms"]}
+    return result
+
+
+def print_startup(startup):
+    print(f"\nStartup: import {startup['import_ms']:.1f} ms, AssistantManager() {startup['manager_ms']:.2f} ms")
+    print("First request (builds the assistant): " +
+          ", ".join(f"{name} {ms:.2f} ms" for name, ms in startup["first_request_ms"].items()))
+
+
+def measure_snapshot(users):
+    # Seconds to write a full snapshot of users greeted users, an incremental one after 1% of them
+    # changed, to restore both, and the average microseconds for a restored user's first request
+    command_types = list(CommandType)
+    manager = AssistantManager(greeting_store=GreetingStore(max_users=users))
+    for index in range(users):
+        manager.greeting_store.claim(f"user-{index}", command_types[index % len(command_types)])
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "state.bin")
+        start = time.perf_counter()
+        manager.snapshot(path)
+        full = time.perf_counter() - start
+        for index in range(0, users, 100):
+            manager.greeting_store.claim(f"user-{index}", CommandType.STUDY)
+        start = time.perf_counter()
+        manager.snapshot(path, incremental=True)
+        incremental = time.perf_counter() - start
+        size = os.path.getsize(path)
+        
+        restored = AssistantManager(greeting_store=GreetingStore(max_users=users))
+        start = time.perf_counter()
+        restored.restore(path)
+        restore = time.perf_counter() - start
+    sample = range(1, users, max(1, users // 10000))
+    start = time.perf_counter()
+    for index in sample:
+        restored.greeting_store.claim(f"user-{index}", CommandType.MUSIC)
+    first_claim = (time.perf_counter() - start) / len(sample)
+    return {
+        "users": users,
+        "bytes": size,
+        "full_snapshot_s": full,
+        "incremental_snapshot_s": incremental,
+        "restore_s": restore,
+        "first_claim_us": first_claim * 1e6
+    }
+
+
+def print_snapshot(snapshot):
+    print(f"\nSnapshot of {snapshot['users']} users ({snapshot['bytes'] / 1e6:.1f} MB): "
+          f"full {snapshot['full_snapshot_s'] * 1000:.0f} ms, incremental {snapshot['incremental_snapshot_s'] * 1000:.1f} ms, "
+          f"restore {snapshot['restore_s'] * 1000:.1f} ms, first request per restored user {snapshot['first_claim_us']:.1f} us")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    print(f"{'scenario':<40} {'ops/sec':>12} {'p50 us':>10} {'p99 us':>10} {'peak KiB':>10}")
+    per_call = False
+    for name, result in results.items():
+        peak = f"{result['peak_kib']:10.0f}" if "peak_kib" in result else f"{'-':>10}"
+        mark = "*" if result.get("latency_per") == "call" else " "
+        per_call = per_call or mark == "*"
+        print(f"{name:<40} {result['ops_per_sec']:12.0f} {result['p50_us']:9.1f}{mark} {result['p99_us']:9.1f}{mark} {peak}")
+    if per_call:
+        print("* latency of a whole call, not of one request")
+
+
+def compare(results, baseline, threshold, p99_threshold=None):
+    # Print the change in throughput and p99 latency against a saved baseline
+    # Returns the names of scenarios whose median throughput dropped by more than threshold
+    # (0.1 = 10%) and whose fastest round is still slower than the baseline's median, so one
+    # noisy round can't pass or fail the gate on its own. p99 of microsecond operations swings far
+    # more than that from run to run, so it only counts when p99_threshold is given, and then only
+    # for latencies of the same kind as the baseline's
+    regressions = []
+    print(f"\nCompared with {baseline.get('commit') or 'baseline'}:")
+    for name, result in results.items():
+        old = baseline["results"].get(name)
+        if old is None:
+            continue
+        throughput = result["ops_per_sec"] / old["ops_per_sec"] - 1 if old["ops_per_sec"] else 0.0
+        tail = result["p99_us"] / old["p99_us"] - 1 if old["p99_us"] else 0.0
+        worse = throughput < -threshold
+        if worse and old.get("ops_per_sec_rounds"):
+            worse = max(result["ops_per_sec_rounds"]) < statistics.median(old["ops_per_sec_rounds"])
+        if p99_threshold is not None and old.get("latency_per") == result["latency_per"]:
+            worse = worse or tail > p99_threshold
+        if worse:
+            regressions.append(name)
+        print(f"{name:<40} ops/sec {throughput:+7.1%}  p99 {tail:+7.1%}{'  REGRESSION' if worse else ''}")
+    return regressions
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="Benchmark the AI assistant routing pipeline")
+    arg_parser.add_argument("--requests", type=int, default=20000, help="synthetic requests per scenario")
+    arg_parser.add_argument("--users", type=int, default=1000, help="distinct users in the traffic")
+    arg_parser.add_argument("--premium-ratio", type=float, default=0.2, help="share of premium users")
+    arg_parser.add_argument("--mix", type=parse_mix, help="command type weights, e.g. music=4,fitness=3,study=2,general=1")
+    arg_parser.add_argument("--catalog-size", type=int, default=0, help="extra study topics and songs in the catalogs")
+    arg_parser.add_argument("--seed", type=int, default=0, help="random seed for the traffic")
+    arg_parser.add_argument("--no-memory", action="store_true", help="skip the peak memory pass")
+    arg_parser.add_argument("--startup", action="store_true", help="also measure import and cold start time")
+    arg_parser.add_argument("--snapshot-users", type=int, metavar="N", help="also time snapshots and restores of N users")
+    arg_parser.add_argument("--save", metavar="PATH", help="write the results as a JSON baseline")
+    arg_parser.add_argument("--compare", metavar="PATH", help="compare against a JSON baseline")
+    arg_parser.add_argument("--repeats", type=int, default=5, help="timed rounds per scenario, the median is reported (default 5)")
+    arg_parser.add_argument("--warmup", type=int, default=1, help="untimed rounds before them (default 1)")
+    arg_parser.add_argument("--round-seconds", type=float, default=0.2,
+                            help="shortest round, quick scenarios pass over the traffic again until it is reached")
+    arg_parser.add_argument("--threshold", type=float, default=0.1,
+                            help="allowed drop in ops/sec before flagging (default 0.1)")
+    arg_parser.add_argument("--p99-threshold", type=float,
+                            help="also flag p99 latency growing by more than this (off by default, p99 is noisy)")
+    args = arg_parser.parse_args(argv)
+
+    if args.repeats <= 0 or args.warmup < 0 or args.round_seconds < 0:
+        arg_parser.error("--repeats must be positive, --warmup and --round-seconds non negative")
+    try:
+        config = BenchmarkConfig(args.requests, args.users, args.premium_ratio, args.mix, args.catalog_size, args.seed)
+    except ValueError as error:
+        arg_parser.error(str(error))
+    results = run(config, measure_memory=not args.no_memory, repeats=args.repeats, warmup=args.warmup,
+                  round_seconds=args.round_seconds)
+    print_results(results)
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "config": config.toDict(),
+        "results": results
+    }
+    if args.startup:
+        report["startup"] = measure_startup()
+        print_startup(report["startup"])
+    if args.snapshot_users:
+        report["snapshot"] = measure_snapshot(args.snapshot_users)
+        print_snapshot(report["snapshot"])
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as output:
+            json.dump(report, output, indent=2)
+        print(f"\nSaved baseline to {args.save}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get("config") != report["config"]:
+            print("\nWarning: the baseline was recorded with a different configuration")
+        if compare(results, baseline, args.threshold, args.p99_threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
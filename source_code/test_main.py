@@ -0,0 +1,834 @@
+import asyncio
+import io
+import json
+import random
+import threading
+import time
+from collections import Counter
+from itertools import chain
+
+import pytest
+
+from main import (AssistantManager, AsyncAssistantServer, CommandParser, CommandType, GreetingStore, KeywordMatcher,
+                  KnowledgeStore, Request, MusicCatalog, ResponseCache, SingleFlight, StudyAssistant, UserProfile, batch_mode)
+
+
+MUSIC, STUDY, FITNESS = CommandType.MUSIC, CommandType.STUDY, CommandType.FITNESS
+
+
+def greeted(store, user_ids, command_types=(MUSIC, STUDY, FITNESS)):
+    return {user_id: {command_type for command_type in command_types if store.hasGreeted(user_id, command_type)}
+            for user_id in user_ids}
+
+
+# GreetingStore dumpState / loadState
+
+def test_full_dump_round_trip():
+    store = GreetingStore()
+    user_ids = ["ann", "bob", "zoë", "", "user-" + "x" * 300, "\ud800lone surrogate"]
+    for index, user_id in enumerate(user_ids):
+        store.claim(user_id, MUSIC)
+        if index % 2:
+            store.claim(user_id, STUDY)
+    restored = GreetingStore()
+    assert restored.loadState(store.dumpState()) == len(user_ids)
+    assert len(restored) == len(user_ids)
+    assert greeted(restored, user_ids) == greeted(store, user_ids)
+    assert not restored.hasGreeted("carol", MUSIC)
+    # A restored user is taken over on first use and keeps its greetings
+    assert not restored.claim("bob", STUDY)
+    assert restored.claim("bob", FITNESS)
+    assert len(restored) == len(user_ids)
+
+
+def test_dump_of_restored_store_round_trips():
+    store = GreetingStore()
+    for index in range(50):
+        store.claim(f"user{index}", MUSIC)
+    middle = GreetingStore()
+    middle.loadState(store.dumpState())
+    middle.claim("user3", STUDY)
+    middle.claim("new", FITNESS)
+    final = GreetingStore()
+    final.loadState(middle.dumpState())
+    user_ids = [f"user{index}" for index in range(50)] + ["new"]
+    assert greeted(final, user_ids) == greeted(middle, user_ids)
+
+
+def test_dump_arrays_are_little_endian():
+    store = GreetingStore()
+    store.claim("a", MUSIC)
+    store.claim("bc", MUSIC)
+    state = store.dumpState()
+    header = GreetingStore.STATE_HEADER.size
+    # masks, then the end offsets of "a" and "bc" in the id blob
+    assert state[header + 2:header + 10] == (1).to_bytes(4, "little") + (3).to_bytes(4, "little")
+
+
+def test_truncated_state_is_rejected():
+    store = GreetingStore()
+    store.claim("ann", MUSIC)
+    with pytest.raises(ValueError):
+        GreetingStore().loadState(store.dumpState()[:-1])
+
+
+def test_incremental_needs_full_dump_first():
+    with pytest.raises(ValueError):
+        GreetingStore().dumpState(incremental=True)
+
+
+def test_delta_replay_with_removals():
+    store = GreetingStore()
+    for user_id in ("ann", "bob", "carol"):
+        store.claim(user_id, MUSIC)
+    replica = GreetingStore()
+    replica.loadState(store.dumpState())
+
+    store.claim("ann", STUDY)
+    store.release("bob", MUSIC)
+    store.claim("dave", FITNESS)
+    assert replica.loadState(store.dumpState(incremental=True)) == 3
+
+    user_ids = ["ann", "bob", "carol", "dave"]
+    assert greeted(replica, user_ids) == greeted(store, user_ids)
+    assert len(replica) == len(store) == 3
+    # Nothing changed since, so the next delta is empty
+    assert replica.loadState(store.dumpState(incremental=True)) == 0
+
+
+def test_delta_replay_keeps_ttl_ages(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: clock[0])
+    store = GreetingStore(ttl=10)
+    store.claim("old", MUSIC)
+    clock[0] += 8
+    store.claim("new", MUSIC)
+    replica = GreetingStore(ttl=10)
+    replica.loadState(store.dumpState())
+    clock[0] += 4  # "old" was seen 12 seconds ago and "new" 4
+    assert not replica.hasGreeted("old", MUSIC)
+    assert replica.hasGreeted("new", MUSIC)
+
+    store.claim("delta", MUSIC)
+    replica.loadState(store.dumpState(incremental=True))
+    clock[0] += 7
+    assert replica.hasGreeted("delta", MUSIC)
+    assert not replica.hasGreeted("new", MUSIC)
+    # Expired users are evicted by the next new greeting
+    replica.claim("later", MUSIC)
+    assert len(replica) == 2
+
+
+def test_restored_users_are_evicted_oldest_first():
+    store = GreetingStore()
+    for index in range(5):
+        store.claim(f"user{index}", MUSIC)
+    store.claim("user0", STUDY)  # user0 is now the most recently seen
+    replica = GreetingStore(max_users=5)
+    replica.loadState(store.dumpState())
+    replica.claim("extra1", MUSIC)
+    replica.claim("extra2", MUSIC)
+    assert replica.evictions == 2
+    assert not replica.hasGreeted("user1", MUSIC)
+    assert not replica.hasGreeted("user2", MUSIC)
+    assert replica.hasGreeted("user0", STUDY)
+    assert replica.hasGreeted("user3", MUSIC)
+
+
+# AssistantManager snapshot / restore
+
+def test_manager_snapshot_with_incremental_records(tmp_path):
+    path = str(tmp_path / "state.bin")
+    manager = AssistantManager()
+    ann = UserProfile("ann", 30, {}, False)
+    bob = UserProfile("bob", 30, {}, False)
+    manager.routeRequest(ann, Request("play happy music", MUSIC))
+    assert manager.snapshot(path) == 1
+    manager.routeRequest(bob, Request("explain oop", STUDY))
+    manager.routeRequest(ann, Request("explain oop", STUDY))
+    assert manager.snapshot(path, incremental=True) == 2
+
+    restored = AssistantManager()
+    assert restored.restore(path) == 2
+    store = restored.greeting_store
+    assert store.hasGreeted("ann", MUSIC) and store.hasGreeted("ann", STUDY)
+    assert store.hasGreeted("bob", STUDY) and not store.hasGreeted("bob", MUSIC)
+    assert restored.assistants[STUDY].interaction_count == 2
+    assert restored.assistants[MUSIC].interaction_count == 1
+
+
+def test_manager_restore_ignores_truncated_tail(tmp_path):
+    path = str(tmp_path / "state.bin")
+    manager = AssistantManager()
+    manager.routeRequest(UserProfile("ann", 30, {}, False), Request("play happy music", MUSIC))
+    manager.snapshot(path)
+    manager.routeRequest(UserProfile("bob", 30, {}, False), Request("explain oop", STUDY))
+    manager.snapshot(path, incremental=True)
+    with open(path, "rb") as source:
+        data = source.read()
+    with open(path, "wb") as output:
+        output.write(data[:-3])  # the appended record was cut short
+
+    restored = AssistantManager()
+    assert restored.restore(path) == 1
+    assert restored.greeting_store.hasGreeted("ann", MUSIC)
+    assert not restored.greeting_store.hasGreeted("bob", STUDY)
+
+
+def test_manager_restore_rejects_other_files(tmp_path):
+    path = tmp_path / "state.bin"
+    path.write_bytes(b"not a snapshot at all")
+    with pytest.raises(ValueError):
+        AssistantManager().restore(str(path))
+
+
+# SingleFlight
+
+def test_single_flight_shares_between_threads():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def work():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "answer"
+
+    results = []
+    def run():
+        results.append(flight.do("key", work))
+
+    leader = threading.Thread(target=run)
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=run) for _ in range(4)]
+    for thread in followers:
+        thread.start()
+    while flight.shared < 4:
+        time.sleep(0.001)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert sorted(results) == [("answer", False)] * 4 + [("answer", True)]
+    assert flight.stats() == {"calls": 1, "shared": 4}
+    assert flight.do("key", lambda: "again") == ("again", True)
+
+
+def test_single_flight_propagates_exceptions():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def work():
+        started.set()
+        release.wait(5)
+        raise KeyError("boom")
+
+    errors = []
+    def run():
+        try:
+            flight.do("key", work)
+        except KeyError as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=run)]
+    threads[0].start()
+    started.wait(5)
+    threads.append(threading.Thread(target=run))
+    threads[1].start()
+    while flight.shared < 1:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(errors) == 2
+
+
+def test_single_flight_follow_and_land():
+    flight = SingleFlight()
+    assert flight.follow("key") == (None, False)
+    # The leader's own thread is not made to wait on itself
+    assert flight.follow("key") == (None, None)
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(flight.follow("key")))
+    waiter.start()
+    while flight.shared < 1:
+        time.sleep(0.001)
+    flight.land("key", "done")
+    waiter.join(5)
+    assert results == [("done", True)]
+
+    # Waiters on an abandoned flight take it over
+    assert flight.follow("other") == (None, False)
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(flight.follow("other")))
+    waiter.start()
+    while flight.shared < 2:
+        time.sleep(0.001)
+    flight.land("other", abandoned=True)
+    waiter.join(5)
+    assert results == [(None, False)]
+    flight.land("other", "mine")
+
+
+def test_single_flight_async_cancel_and_retry():
+    async def scenario():
+        flight = SingleFlight()
+        calls = []
+
+        async def work(delay):
+            calls.append(delay)
+            await asyncio.sleep(delay)
+            return delay
+
+        leader = asyncio.ensure_future(flight.doAsync("key", work, 10))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.doAsync("key", work, 0.01))
+        await asyncio.sleep(0)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        # The follower ran the work itself once the leader was cancelled
+        assert await follower == (0.01, True)
+        assert calls == [10, 0.01]
+
+        # Cancelling a follower leaves the leader running
+        leader = asyncio.ensure_future(flight.doAsync("key", work, 0.01))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.doAsync("key", work, 10))
+        await asyncio.sleep(0)
+        follower.cancel()
+        assert await leader == (0.01, True)
+        assert not flight._futures
+
+    asyncio.run(scenario())
+
+
+def test_single_flight_async_exception():
+    async def scenario():
+        flight = SingleFlight()
+
+        async def work():
+            await asyncio.sleep(0.01)
+            raise KeyError("boom")
+
+        results = await asyncio.gather(*(flight.doAsync("key", work) for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(result, KeyError) for result in results)
+        assert flight.stats() == {"calls": 1, "shared": 2}
+
+    asyncio.run(scenario())
+
+
+# KeywordMatcher
+
+def naiveFindAll(entries, text):
+    isWord = lambda index: 0 <= index < len(text) and (text[index].isalnum() or text[index] == "_")
+    hits = []
+    for keyword, value, *endings in entries:
+        start = text.find(keyword)
+        while start >= 0:
+            end = start + len(keyword)
+            if not isWord(start - 1) and (not endings or any(text.startswith(ending, end) and not isWord(end + len(ending))
+                                                              for ending in endings[0])):
+                hits.append(value)
+            start = text.find(keyword, start + 1)
+    return hits
+
+
+def test_keyword_matcher_matches_naive_scan():
+    entries = [("play", 1), ("playlist", 2), ("list", 3), ("lay", 4), ("c++", 5), ("c", 6),
+               ("he", 7), ("she", 8), ("hers", 9), ("his", 10), ("aaa", 11), ("aa", 12),
+               ("lay", 13, ("",)), ("pla", 14, ("", "s", "ying")), ("c", 15, ("", "+"))]
+    matcher = KeywordMatcher(entries)
+    texts = ["play me a playlist", "display the list", "ushers", "learn c++ and c#", "aaaaa", "", "x_play play"]
+    randomizer = random.Random(18)
+    alphabet = "aplyhiesrc+ _"
+    texts += ["".join(randomizer.choice(alphabet) for _ in range(randomizer.randrange(40))) for _ in range(500)]
+    for text in texts:
+        assert Counter(matcher.findAll(text)) == Counter(naiveFindAll(entries, text)), text
+
+
+def test_preference_keywords_must_end_the_word():
+    parser = CommandParser()
+    for text in ("programming in python", "news", "hardware", "popular songs", "a metallic sound"):
+        assert parser.extractPreferences(text) == {}, text
+    assert parser.extractPreferences("easy songs for beginners") == {"fitness_level": "beginner"}
+    assert parser.extractPreferences("starting with some rocks") == {"fitness_level": "beginner", "genre": "rock"}
+    assert parser.parseCommand("songs") == MUSIC and parser.parseCommand("play my playlist") == MUSIC
+
+
+def test_keyword_matcher_reports_matches_in_end_order():
+    matcher = KeywordMatcher([("workout", "w"), ("music", "m"), ("out", "o")])
+    assert matcher.findAll("music workout music") == ["m", "w", "m"]
+
+
+# CommandParser
+
+def randomInputs(parser, seed, count):
+    randomizer = random.Random(seed)
+    words = [keyword for keywords in parser.keywords.values() for keyword in keywords]
+    for table in parser.preference_keywords.values():
+        words.extend(chain.from_iterable(table.values()) if isinstance(table, dict) else table)
+    words += ["please", "the", "display", "Today", "!", "  "]
+    inputs = [" ".join(randomizer.choice(words) for _ in range(randomizer.randrange(6))) for _ in range(count)]
+    return inputs + inputs[:count // 4]
+
+
+def parsedFields(parsed):
+    return (parsed.text, parsed.normalized, parsed.tokens, parsed.command_type, parsed.scores, parsed.preferences)
+
+
+@pytest.mark.parametrize("weights", [{}, {"play": 3.0, "explain": 0.5, "workout": 2.0}])
+def test_parse_batch_matches_parse(weights):
+    parser = CommandParser()
+    parser.keyword_weights.update(weights)
+    parser.temperature = 0.8
+    parser.compile()
+    for size in (5, 400):  # below and above IntentScorer.vector_threshold
+        inputs = randomInputs(parser, size, size)
+        for text, batched in zip(inputs, parser.parseBatch(inputs)):
+            single = parser.parse(text)
+            assert parsedFields(batched) == parsedFields(single), text
+            assert batched.confidence == pytest.approx(single.confidence), text
+
+
+# Batch mode
+
+def test_batch_mode_reports_bad_records_and_keeps_the_rest():
+    records = [
+        '{"user": "a", "age": 20, "preferences": {"genre": ["rock", "pop"]}, "text": "play happy music"}',
+        '{"user": "b", "age": 20, "preferences": {"genre": 5}, "text": "play happy music"}',
+        '{"user": "c", "age": 20, "preferences": {"genre": "rock"}, "text": "play happy music"}',
+        'not json',
+        '',
+        '{"user": "d", "age": -1, "text": "explain oop"}',
+        '{"user": "e", "age": 30, "text": "explain oop"}',
+    ]
+    output = io.StringIO()
+    batch_mode(io.StringIO("\n".join(records) + "\n"), output, chunk_size=3)
+    results = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [result["line"] for result in results] == [1, 2, 3, 4, 6, 7]
+    assert [("error" in result) for result in results] == [True, True, False, True, True, False]
+    assert "genre" in results[0]["error"]
+    assert results[2]["type"] == "MUSIC" and results[5]["type"] == "STUDY"
+
+
+def test_batch_mode_isolates_records_an_assistant_fails_on():
+    class FailingStudy(StudyAssistant):
+        def handleRequest(self, user, request):
+            if user.name == "broken":
+                raise RuntimeError("assistant failed")
+            return super().handleRequest(user, request)
+
+    manager = AssistantManager()
+    manager.assistants[STUDY] = FailingStudy()
+    records = [json.dumps({"user": name, "age": 20, "text": text})
+               for name, text in (("ok1", "explain oop"), ("broken", "explain recursion"), ("ok2", "explain oop"))]
+    output = io.StringIO()
+    batch_mode(io.StringIO("\n".join(records)), output, manager=manager)
+    results = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert results[1] == {"line": 2, "error": "assistant failed"}
+    assert [result["user"] for result in (results[0], results[2])] == ["ok1", "ok2"]
+    # The failed batch released its greetings, so each user is greeted once
+    assert results[0]["message"].startswith("Hello ok1!") and results[2]["message"].startswith("Hello ok2!")
+
+
+# AsyncAssistantServer
+
+def test_server_stop_cancels_requests_in_flight():
+    class SlowStudy(StudyAssistant):
+        async def handleRequestAsync(self, user, request):
+            await asyncio.sleep(2)
+            return self.handleRequest(user, request)
+
+    async def scenario():
+        manager = AssistantManager()
+        manager.assistants[STUDY] = SlowStudy()
+        server = AsyncAssistantServer(manager, max_concurrency=1)
+        user = UserProfile("ann", 30, {}, False)
+        handled = asyncio.ensure_future(server.submit(user, "explain oop"))
+        queued = asyncio.ensure_future(server.submit(user, "explain recursion"))
+        await asyncio.sleep(0.05)
+        started = time.perf_counter()
+        await server.stop()
+        for request in (handled, queued):
+            with pytest.raises(asyncio.CancelledError):
+                await asyncio.wait_for(request, 1)
+        assert time.perf_counter() - started < 1
+
+    asyncio.run(scenario())
+
+
+# MusicCatalog
+
+def bruteForceTopK(tracks, k, mood=None, genre=None, tags=()):
+    genres = {genre.lower()} if isinstance(genre, str) else {name.lower() for name in genre or ()}
+    tags = {tag.lower() for tag in tags}
+    matches = [track for track in tracks
+               if (not mood or track.mood == mood.lower()) and (not genres or track.genre in genres) and tags <= track.tags]
+    matches.sort(key=lambda track: (-track.popularity, track.track_id))
+    return [track.track_id for track in matches[:k]]
+
+
+def randomCatalogRows(seed, count):
+    randomizer = random.Random(seed)
+    moods, genres, tags = ["happy", "Sad", "calm"], ["pop", "Rock", "jazz", "folk"], ["live", "Remix", "90s", "acoustic"]
+    return [(f"Song {index}", randomizer.choice(moods), randomizer.choice(genres), randomizer.randrange(20),
+             randomizer.sample(tags, randomizer.randrange(3)))
+            for index in range(count)]
+
+
+def randomQueries(seed, count):
+    randomizer = random.Random(seed)
+    for _ in range(count):
+        mood = randomizer.choice([None, "happy", "SAD", "calm", "angry"])
+        genre = randomizer.choice([None, "pop", "ROCK", ["jazz", "Folk"], ["pop"], "metal"])
+        tags = randomizer.sample(["live", "remix", "90S", "acoustic", "rare"], randomizer.randrange(3))
+        yield randomizer.choice([1, 3, 50]), mood, genre, tags
+
+
+def test_top_k_matches_brute_force():
+    catalog = MusicCatalog()
+    rows = randomCatalogRows(13, 1500)
+    catalog.addMany(rows[:1000])
+    for row in rows[1000:]:
+        catalog.add(*row)
+    tracks = list(catalog)
+    for k, mood, genre, tags in randomQueries(13, 300):
+        found = [track.track_id for track in catalog.topK(k, mood, genre, tags)]
+        assert found == bruteForceTopK(tracks, k, mood, genre, tags), (k, mood, genre, tags)
+
+
+def test_top_k_rejects_non_string_genre():
+    catalog = MusicCatalog()
+    catalog.add("Song", "happy", "pop")
+    with pytest.raises(TypeError):
+        catalog.topK(1, "happy", 5)
+
+
+def test_genre_preference_is_case_insensitive():
+    manager = AssistantManager()
+    response = manager.routeRequest(UserProfile("ann", 30, {"genre": "Rock"}, False), Request("play happy music", MUSIC))
+    assert "preference for Rock" in response.message and "Feel Good Inc" in response.message
+
+
+# KnowledgeStore
+
+def test_stored_catalog_matches_in_memory(tmp_path):
+    rows = randomCatalogRows(17, 600)
+    catalog = MusicCatalog()
+    catalog.addMany(rows[:500])
+    stored = KnowledgeStore.build(str(tmp_path / "store.db"), music=catalog)
+    stored_catalog = AssistantManager(store=stored).assistants[MUSIC].catalog
+    for row in rows[500:]:
+        catalog.add(*row)
+        stored_catalog.add(*row)
+    assert [track.title for track in stored_catalog] == [track.title for track in catalog]
+    assert stored_catalog.moods() == catalog.moods()
+    for k, mood, genre, tags in randomQueries(17, 200):
+        expected = [track.title for track in catalog.topK(k, mood, genre, tags)]
+        assert [track.title for track in stored_catalog.topK(k, mood, genre, tags)] == expected, (k, mood, genre, tags)
+    for bad_row in (("", "happy", "pop"), ("Song", "happy", 5), ("Song", "happy", "pop", "high")):
+        with pytest.raises((TypeError, ValueError)) as in_memory:
+            catalog.add(*bad_row)
+        with pytest.raises(in_memory.type):
+            stored_catalog.add(*bad_row)
+    assert len(stored_catalog) == len(catalog)
+
+
+def test_stored_assistants_answer_like_in_memory(tmp_path):
+    stored = KnowledgeStore.build(str(tmp_path / "store.db"))
+    in_memory, from_store = AssistantManager(), AssistantManager(store=stored)
+    users = [UserProfile("ann", 30, {}, False), UserProfile("bob", 40, {"genre": "rock", "fitness_level": "advanced"}, True)]
+    texts = ["play happy music", "play sad jazz", "strength workout", "cardio for beginners", "explain oop",
+             "what is machine learning", "teach me basket weaving", "hello"]
+    pairs = [(user, text) for user in users for text in texts]
+    for (user, text), expected, answer in zip(pairs, in_memory.routeBatch(pairs), from_store.routeBatch(pairs)):
+        assert (answer.message, answer.confidence) == (expected.message, expected.confidence), (user.name, text)
+
+
+# AssistantRegistry
+
+def test_unload_idle_hands_counts_to_the_next_assistant():
+    manager = AssistantManager()
+    user = UserProfile("ann", 30, {}, False)
+    for _ in range(3):
+        manager.routeRequest(user, Request("play happy music", MUSIC))
+    old = manager.assistants[MUSIC]
+    assert manager.assistants.unloadIdle(-1) == [MUSIC]
+    assert not manager.assistants.isLoaded(MUSIC)
+    # A request still running on the unloaded assistant counts before and after it is replaced
+    old.countInteraction()
+    assert manager.assistants.interactionCounts()[old.name] == 4
+    manager.routeRequest(user, Request("play sad music", MUSIC))
+    new = manager.assistants[MUSIC]
+    assert new is not old and new.interaction_count == 5
+    old.countInteraction()
+    assert new.interaction_count == 6 and manager.assistants.interactionCounts()[new.name] == 6
+
+
+def test_unload_idle_loses_no_counts_from_other_threads():
+    manager = AssistantManager()
+    user = UserProfile("ann", 30, {}, False)
+    manager.routeRequest(user, Request("explain oop", STUDY))
+    old = manager.assistants[STUDY]
+    manager.assistants.unloadIdle(-1)
+    
+    def count():
+        for _ in range(2000):
+            old.countInteraction()
+    
+    threads = [threading.Thread(target=count) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for _ in range(20):
+        manager.routeRequest(user, Request("explain oop", STUDY))
+        manager.assistants.unloadIdle(-1)
+    for thread in threads:
+        thread.join()
+    assert manager.assistants.interactionCounts()[old.name] == 1 + 4 * 2000 + 20
+
+
+# ResponseCache
+
+def test_cache_skips_unhashable_preferences():
+    manager = AssistantManager(response_cache=ResponseCache())
+    user = UserProfile("ann", 30, {"genre": ["rock", "pop"], "fitness_level": ["advanced"]}, False)
+    for text, command_type in (("play happy music", MUSIC), ("strength workout", FITNESS)):
+        first = manager.routeRequest(user, Request(text, command_type))
+        second = manager.routeRequest(user, Request(text, command_type))
+        assert first.message.split("\n\n")[-1] == second.message
+    assert manager.response_cache.stats()["hits"] == 0
+
+
+def test_cache_is_invalidated_when_the_data_changes():
+    manager = AssistantManager(response_cache=ResponseCache())
+    user = UserProfile("ann", 30, {}, False)
+    request = lambda: Request("play happy music", MUSIC)
+    manager.routeRequest(user, request())
+    cached = manager.routeRequest(user, request())
+    assert manager.response_cache.stats()["hits"] == 1
+    manager.assistants[MUSIC].addSong("Happy - Pharrell Williams", "happy", "pop", popularity=100)
+    fresh = manager.routeRequest(user, request())
+    assert "Happy - Pharrell Williams" in fresh.message and "Happy - Pharrell" not in cached.message
+    assert manager.response_cache.stats()["hits"] == 1
+
+
+# Batch routing
+
+def trafficSample(seed, count):
+    randomizer = random.Random(seed)
+    users = [UserProfile(f"user{index}", 20 + index, preferences, index % 3 == 0)
+             for index, preferences in enumerate([{}, {"genre": "rock"}, {"fitness_level": "advanced"}, {"genre": "Pop"}, {}])]
+    texts = ["play happy music", "play some sad rock songs", "I need a strength workout", "cardio for beginners",
+             "explain oop", "explain recursion please", "what can you do", "play music", "flexibility routine"]
+    return [(randomizer.choice(users), randomizer.choice(texts)) for _ in range(count)]
+
+
+def test_batch_matches_sequential_routing():
+    items = trafficSample(4, 300)
+    sequential = AssistantManager()
+    expected = []
+    for user, text in items:
+        parsed = sequential.parser.parse(text)
+        expected.append(sequential.routeRequest(user, Request(text, parsed.command_type, parsed=parsed)))
+    batched = AssistantManager()
+    responses = []
+    for start in range(0, len(items), 64):
+        responses.extend(batched.routeBatch(items[start:start + 64]))
+    assert [(response.message, response.confidence, response.actionPerformed) for response in responses] == \
+           [(response.message, response.confidence, response.actionPerformed) for response in expected]
+    assert batched.metricsSnapshot()["interaction_count"] == sequential.metricsSnapshot()["interaction_count"]
+
+
+def test_batch_does_not_share_unhashable_preferences():
+    manager = AssistantManager()
+    user = UserProfile("ann", 30, {"genre": ["rock", "pop"], "fitness_level": ["advanced"]}, False)
+    responses = manager.routeRequestBatch([(user, Request("play happy music", MUSIC)),
+                                           (user, Request("play happy music", MUSIC)),
+                                           (user, Request("strength workout", FITNESS)),
+                                           (user, Request("strength workout", FITNESS))])
+    assert responses[0].message.endswith(responses[1].message)
+    assert responses[2].message.endswith(responses[3].message)
+
+
+# StudyAssistant
+
+def test_unmatched_question_lists_a_few_topics():
+    assistant = StudyAssistant()
+    assert assistant.explainTopic(UserProfile("ann", 30, {}, False), "teach me something").message == (
+        "I can explain: oop, ai, python, data structures, algorithms. What would you like to learn about?")
+    for index in range(1000):
+        assistant.addTopic(f"course {index}", "One course.")
+    message = assistant.explainTopic(UserProfile("ann", 30, {}, False), "teach me something").message
+    assert message == ("I can explain: oop, ai, python, data structures, algorithms, course 0, course 1, course 2, "
+                       "course 3, course 4 and 995 more. What would you like to learn about?")
+
+
+def test_topics_are_distinct_by_key():
+    assistant = StudyAssistant()
+    assistant.addTopic("C++", "A language.")
+    assistant.addTopic("C#", "Another language.")
+    assistant.addTopic("C", "The older one.")
+    user = UserProfile("ann", 30, {}, False)
+    assert "explanation of C++:" in assistant.explainTopic(user, "explain c++").message
+    assert "explanation of C#:" in assistant.explainTopic(user, "explain c#").message
+    assert "explanation of C:" in assistant.explainTopic(user, "explain c").message
+    with pytest.raises(ValueError):
+        assistant.addTopic("c++", "Same key as C++.")
+
+
+# Streaming responses
+
+@pytest.mark.parametrize("options", [{}, {"coalesce": True, "response_cache": ResponseCache()}])
+def test_streamed_chunks_join_to_the_response(options):
+    items = trafficSample(7, 200)
+    routed, streamed, streamed_async = AssistantManager(), AssistantManager(**options), AssistantManager(**options)
+    request = lambda text: Request(text, routed.parser.parse(text).command_type)
+    
+    async def scenario():
+        chunk_counts = []
+        for user, text in items:
+            expected = routed.routeRequest(user, request(text))
+            stream = streamed.streamRequest(user, request(text))
+            chunks = list(stream)
+            async_stream = streamed_async.streamRequestAsync(user, request(text))
+            async_chunks = [chunk async for chunk in async_stream]
+            for parts, response in ((chunks, stream.response), (async_chunks, async_stream.response)):
+                assert "".join(parts) == response.message, text
+                assert (response.message, response.confidence, response.actionPerformed) == \
+                    (expected.message, expected.confidence, expected.actionPerformed), text
+            chunk_counts.append(len(chunks))
+        return chunk_counts
+    
+    assert max(asyncio.run(scenario())) > 2  # greetings and premium playlists come in several chunks
+
+
+# Coalesced streams
+
+class SlowAsyncStudy(StudyAssistant):
+    calls = 0
+
+    async def handleRequestAsync(self, user, request):
+        SlowAsyncStudy.calls += 1
+        await asyncio.sleep(0.05)
+        return self.handleRequest(user, request)
+
+
+def test_server_streams_share_one_answer():
+    async def scenario():
+        SlowAsyncStudy.calls = 0
+        manager = AssistantManager(coalesce=True)
+        manager.assistants[STUDY] = SlowAsyncStudy()
+        server = AsyncAssistantServer(manager)
+
+        async def session(index):
+            chunks = []
+            async def write(chunk):
+                chunks.append(chunk)
+            response = await server.submitStream(UserProfile(f"user{index}", 30, {}, False), "explain oop", write)
+            return "".join(chunks), response.message
+
+        results = await asyncio.gather(*(session(index) for index in range(8)))
+        await server.stop()
+        assert all(streamed == message for streamed, message in results)
+        assert [message.startswith(f"Hello user{index}!") for index, (_, message) in enumerate(results)] == [True] * 8
+        assert SlowAsyncStudy.calls == 1
+        assert manager.single_flight.stats() == {"calls": 1, "shared": 7}
+        assert manager.assistants[STUDY].interaction_count == 8
+
+    asyncio.run(scenario())
+
+
+def test_slow_reader_does_not_hold_up_coalesced_streams():
+    async def scenario():
+        manager = AssistantManager(coalesce=True)
+        manager.assistants[STUDY] = SlowAsyncStudy()
+        server = AsyncAssistantServer(manager, request_timeout=5)
+        finished = {}
+
+        async def session(name, delay):
+            written = []
+            async def write(chunk):
+                if written:  # the greeting goes out at once, the answer slowly
+                    await asyncio.sleep(delay)
+                written.append(chunk)
+            started = time.perf_counter()
+            await server.submitStream(UserProfile(name, 30, {}, False), "explain oop", write)
+            finished[name] = time.perf_counter() - started
+
+        leader = asyncio.ensure_future(session("slow", 0.5))
+        await asyncio.sleep(0.01)
+        await asyncio.gather(*(session(f"fast{index}", 0) for index in range(3)))
+        assert max(finished.values()) < 0.4 and "slow" not in finished
+        await leader
+        await server.stop()
+        assert manager.single_flight.stats()["shared"] == 3
+
+    asyncio.run(scenario())
+
+
+def test_sync_streams_share_one_answer_between_threads():
+    class SlowStream(StudyAssistant):
+        calls = 0
+
+        def streamRequest(self, user, request):
+            SlowStream.calls += 1
+            time.sleep(0.05)
+            return (yield from super().streamRequest(user, request))
+
+    manager = AssistantManager(coalesce=True)
+    manager.assistants[STUDY] = SlowStream()
+    streamed = []
+
+    def session(index):
+        stream = manager.streamRequest(UserProfile(f"user{index}", 30, {}, False), Request("explain oop", STUDY))
+        streamed.append("".join(stream) == stream.response.message)
+
+    threads = [threading.Thread(target=session, args=(index,)) for index in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert streamed == [True] * 6
+    assert SlowStream.calls == 1
+
+
+# Chat sessions
+
+def chatSession(port, lines):
+    async def run():
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write("".join(line + "\n" for line in lines).encode())
+        await writer.drain()
+        output = await reader.read()
+        writer.close()
+        return output.decode()
+    return run()
+
+
+def test_sessions_with_the_same_name_are_different_users():
+    async def scenario():
+        server = AsyncAssistantServer(AssistantManager())
+        await server.start()
+        listener = await asyncio.start_server(server._handleSession, "127.0.0.1", 0)
+        port = listener.sockets[0].getsockname()[1]
+        guest = ["Alice", "", "30", "n", "explain oop", "quit"]
+        first = await chatSession(port, guest)
+        second = await chatSession(port, guest)
+        login = ["Alice", "alice-1", "30", "n", "explain oop", "quit"]
+        third = await chatSession(port, login)
+        again = await chatSession(port, login)
+        listener.close()
+        await listener.wait_closed()
+        await server.stop()
+        return first, second, third, again
+
+    first, second, third, again = asyncio.run(scenario())
+    # Guests are greeted every time, a user id keeps its greetings across connections
+    assert "Hello Alice!" in first and "Hello Alice!" in second and "Hello Alice!" in third
+    assert "Hello Alice!" not in again and "explanation of oop" in again